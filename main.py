@@ -1,22 +1,104 @@
 """
 FastAPI application for natural language to SQL conversion
-This API provides two main endpoints:
+This API provides these endpoints:
 - /generate-sql: Converts natural language queries to SQL
 - /execute-sql: Executes SQL queries against the database
+- /execute-sql/stream: Streams a read-only query's rows as NDJSON
 """
-from typing import Dict, List, Any
+import asyncio
+import base64
+import logging
+import queue
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, AsyncIterator, Dict, List
 from fastapi import FastAPI, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
 from pydantic import BaseModel
-from utils import generate_sql_query, execute_sql_query
+from utils import generate_sql_query, aexecute_sql_query, aget_db_schema, stream_sql_query
+
+# Logging only enqueues records on the request path; a listener thread
+# does the formatting and file I/O
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_file_handler = logging.FileHandler("sql_operations.log")
+_log_file_handler.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+)
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+
+def _json_default(value: Any) -> Any:
+    """
+    Serialize values orjson doesn't handle natively
+    SQLite BLOBs come back as bytes: UTF-8 text is returned as a string (as
+    FastAPI's encoder did), anything else base64-encoded.
+    """
+    if isinstance(value, bytes):
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            return base64.b64encode(value).decode("ascii")
+    raise TypeError
+
+class SQLJSONResponse(ORJSONResponse):
+    """ORJSONResponse that can also serialize BLOB values"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_json_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """
+    Set up shared resources before the first request and release them on shutdown
+    Starts the background log listener, then opens the database and caches
+    its schema, so the one-off WAL switch doesn't run on a request. Queued
+    log records are flushed when the app stops.
+    """
+    _log_listener.start()
+    try:
+        await aget_db_schema()
+        yield
+    finally:
+        _log_listener.stop()
 
 # Initialize FastAPI app
-app = FastAPI(title="Txt to SQL API")
+app = FastAPI(
+    title="Txt to SQL API", default_response_class=SQLJSONResponse, lifespan=lifespan
+)
+# Result sets are plain JSON and compress well; tiny bodies are left alone
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 class QueryRequest(BaseModel):
     """Request model for query endpoints"""
     query: str
 
-@app.post("/generate-sql")
+class ExecuteSQLRequest(QueryRequest):
+    """Request model for /execute-sql"""
+    # Values bound to ? placeholders; repeated query shapes reuse SQLite's
+    # prepared statement instead of being parsed again
+    params: List[Any] = []
+
+# Response models are only used for OpenAPI docs, not runtime validation
+class GenerateSQLResponse(BaseModel):
+    """Response model for /generate-sql"""
+    query: str
+
+class ExecuteSQLResponse(BaseModel):
+    """Response model for /execute-sql"""
+    results: List[Dict[str, Any]]
+
+@app.post(
+    "/generate-sql",
+    response_model=None,
+    responses={200: {"model": GenerateSQLResponse}},
+)
 async def generate_sql(request: QueryRequest) -> Dict[str, str]:
     """
     Generate SQL query from natural language input
@@ -28,28 +110,63 @@ async def generate_sql(request: QueryRequest) -> Dict[str, str]:
         HTTPException: If query generation fails
     """
     try:
-        sql_query = generate_sql_query(request.query)
+        sql_query = await generate_sql_query(request.query)
         return {"query": sql_query}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
-@app.post("/execute-sql")
-async def execute_sql(request: QueryRequest) -> Dict[str, List[Dict[str, Any]]]:
+@app.post(
+    "/execute-sql",
+    response_model=None,
+    responses={200: {"model": ExecuteSQLResponse}},
+)
+async def execute_sql(request: ExecuteSQLRequest) -> SQLJSONResponse:
     """
     Execute SQL query and return results
+    Result sets can be large, so they are serialized straight to orjson
+    without a response model validation pass.
     Args:
-        request: QueryRequest object containing the SQL query
+        request: ExecuteSQLRequest object containing the SQL query and parameters
     Returns:
-        Dictionary containing the query results
+        JSON response containing the query results
     Raises:
         HTTPException: If query execution fails
     """
     try:
-        results = execute_sql_query(request.query)
-        return {"results": results}
+        results = await aexecute_sql_query(request.query, request.params)
+        return SQLJSONResponse({"results": results})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+@app.post("/execute-sql/stream", response_class=StreamingResponse)
+async def execute_sql_stream(request: ExecuteSQLRequest) -> StreamingResponse:
+    """
+    Execute a read-only SQL query and stream its rows as NDJSON
+    Rows are sent as SQLite returns them, one JSON object per line, so large
+    results never have to fit in memory.
+    Args:
+        request: ExecuteSQLRequest object containing the SQL query and parameters
+    Returns:
+        Streaming application/x-ndjson response
+    Raises:
+        HTTPException: If the query is not read-only or fails to start
+    """
+    try:
+        batches = await asyncio.to_thread(stream_sql_query, request.query, request.params)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
+    return StreamingResponse(
+        (
+            b"".join([
+                orjson.dumps(row, default=_json_default, option=orjson.OPT_APPEND_NEWLINE)
+                for row in batch
+            ])
+            for batch in batches
+        ),
+        media_type="application/x-ndjson",
+    )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # uvloop/httptools come with uvicorn[standard]; fail loudly if missing
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools") 
\ No newline at end of file
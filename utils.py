@@ -2,21 +2,171 @@
 Utility functions for database operations and SQL query generation
 This module provides functionality for:
 - Database connection management
-- SQL query generation using OpenAI's GPT-4
+- SQL query generation using OpenAI's GPT-4o models
 - SQL query execution
 """
+import asyncio
+import atexit
+import hashlib
+import logging
 import os
+import re
 import sqlite3
-from typing import List, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Iterator, Mapping, Optional, Sequence, Tuple
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
 
-# Load OpenAI API key from .env
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Load settings (OpenAI API key etc.) from .env
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("API key not found in .env file")
-client = OpenAI(api_key=api_key)
+
+# Most requests are simple translations the small model handles; long or
+# analytical requests are routed to the larger one
+SQL_MODEL = os.getenv("SQL_MODEL", "gpt-4o-mini")
+SQL_COMPLEX_MODEL = os.getenv("SQL_COMPLEX_MODEL", "gpt-4o")
+COMPLEX_QUERY_MIN_LENGTH = 200
+_COMPLEX_QUERY_RE = re.compile(
+    r"\b(pivot|window|recursive|rank(ing)?|running total|cumulative|percentile)\b",
+    re.IGNORECASE,
+)
+
+# Near-deterministic sampling; a single query never needs more output tokens
+SQL_TEMPERATURE = 0.1
+SQL_MAX_TOKENS = 512
+# Output token limit of gpt-4o and gpt-4o-mini; batched requests are split so
+# that SQL_MAX_TOKENS per query stays within it
+MODEL_MAX_OUTPUT_TOKENS = 16_384
+BATCH_MAX_QUERIES = MODEL_MAX_OUTPUT_TOKENS // SQL_MAX_TOKENS
+
+# Stable system message, always sent first so OpenAI's automatic prefix
+# cache can match it byte-for-byte across requests
+_SYSTEM_PROMPT = """Write one SQLite query for the request, using the schema in the user message.
+- Use the schema's exact table and column names; the request's letter case doesn't matter.
+- Each answer is SQL only: UPPERCASE keywords, indented.
+- To delete or change data or the schema, answer with a confirmation question instead, until the request says "I grant administrative permission"."""
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+
+# Running OpenAI token totals, to check that prefix caching is paying off
+_USAGE_TOTALS = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+_USAGE_LOCK = threading.Lock()
+
+# Retries with exponential backoff and jitter are left to the OpenAI SDK.
+# After BREAKER_FAIL_MAX consecutive outage errors, calls fail fast for
+# BREAKER_RESET_TIMEOUT seconds instead of piling up behind a sick API
+OPENAI_MAX_RETRIES = 3
+# Non-streaming completions send nothing until they finish, so the read
+# timeout grows with max_tokens at the slowest expected output rate
+OPENAI_TIMEOUT = 30.0
+OPENAI_CONNECT_TIMEOUT = 5.0
+OPENAI_MIN_TOKENS_PER_SECOND = 40.0
+BREAKER_FAIL_MAX = 10
+BREAKER_RESET_TIMEOUT = 30.0
+_breaker_failures = 0
+_breaker_open_until = 0.0
+_BREAKER_LOCK = threading.Lock()
+
+# Optional client-side rate limits matching the account's quota, so bursts
+# queue here instead of bouncing off 429s; unset means unlimited
+_openai_rpm = os.getenv("OPENAI_RPM")
+_openai_tpm = os.getenv("OPENAI_TPM")
+OPENAI_RPM = float(_openai_rpm) if _openai_rpm else None
+OPENAI_TPM = float(_openai_tpm) if _openai_tpm else None
+
+# Exact tier: generated SQL keyed on a hash of model + schema + normalized
+# query, with an expiry time so stale answers age out
+SQL_CACHE_MAX_SIZE = 512
+SQL_CACHE_TTL = 3600.0  # seconds
+_SQL_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_SQL_CACHE_LOCK = threading.Lock()
+_sql_cache_schema_digest = ""
+
+# Optional semantic tier: set SEMANTIC_CACHE_THRESHOLD (e.g. 0.95) to also
+# reuse SQL for paraphrased queries, matched by embedding cosine similarity
+_semantic_threshold = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+SEMANTIC_CACHE_THRESHOLD = float(_semantic_threshold) if _semantic_threshold else None
+EMBEDDING_MODEL = "text-embedding-3-small"
+_semantic_embeddings: Any = None  # numpy array of shape (N, dims), unit rows
+_semantic_queries: List[str] = []
+_semantic_expiry: List[float] = []
+
+# Results of read-only queries, keyed on SQL + params + database version.
+# Memory is bounded by rows held across all entries (~0.4 KB each for the
+# shipped tables); results over the per-entry cap are not kept
+RESULT_CACHE_MAX_SIZE = 128
+RESULT_CACHE_MAX_ROWS = 20_000
+RESULT_CACHE_MAX_ENTRY_ROWS = 2_000
+_RESULT_CACHE: "OrderedDict[Tuple[Any, ...], List[Dict[str, Any]]]" = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+_result_cache_rows = 0
+
+# Punctuation that doesn't change a request's meaning; a dot is kept when it
+# is a decimal point and "!" when it is part of "!="
+_QUERY_PUNCT_RE = re.compile(r"[?,;:\"'`]|!(?!=)|\.(?!\d)")
+
+# SQL whose result changes between runs, so results can't be cached. The
+# date/time functions default to "now" without a time value, so any call
+# to them skips the cache
+_NONDETERMINISTIC_RE = re.compile(
+    r"\b(random|randomblob|current_date|current_time|current_timestamp)\b"
+    r"|\b(date|time|datetime|julianday|unixepoch|strftime|timediff)\s*\("
+    r"|'now'",
+    re.IGNORECASE,
+)
+
+# Structured outputs: replies are JSON objects matching these schemas, so
+# the SQL needs no markdown fences or text parsing
+_SQL_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "sql_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"sql": {"type": "string"}},
+            "required": ["sql"],
+            "additionalProperties": False,
+        },
+    },
+}
+_SQL_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "sql_batch_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"queries": {"type": "array", "items": {"type": "string"}}},
+            "required": ["queries"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Leading SELECT keyword; matched in place without copying the query
+_SELECT_RE = re.compile(r"\s*SELECT\b", re.IGNORECASE)
+
+DB_PATH = "data.db"
+
+# One SQLite connection per thread, reused across requests
+_local = threading.local()
+_pooled_connections: List[sqlite3.Connection] = []
+
+# Dedicated threads for blocking SQLite work from async code; each keeps its
+# own WAL connections, so reads run in parallel
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sqlite")
+
+# Formatted schema, keyed on the database version (see _get_db_version)
+_SCHEMA_CACHE: Optional[Tuple[Tuple[int, int, int], str]] = None
+_SCHEMA_LOCK = threading.Lock()
 
 # Custom error classes
 class SQLGenerationError(Exception):
@@ -25,35 +175,449 @@ class SQLGenerationError(Exception):
 class SQLExecutionError(Exception):
     """Custom error for SQL execution failures"""
 
-def get_db_connection() -> sqlite3.Connection:
+def _open_db_connection(read_only: bool) -> sqlite3.Connection:
+    """Open a new database connection with this module's settings"""
+    # A larger statement cache keeps prepared plans for repeated SQL
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    if logger.isEnabledFor(logging.DEBUG):
+        conn.set_trace_callback(logger.debug)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA cache_size=-64000;")  # ~64 MB page cache
+    if read_only:
+        # SQLite itself then refuses any change to the database files, while
+        # table-valued functions such as json_each and pragma_* still work
+        conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+def get_db_connection(read_only: bool = False) -> sqlite3.Connection:
     """
-    Create and return database connection
+    Return the calling thread's database connection, opening it on first use
+    New connections are switched to WAL so readers don't block the writer.
+    Read-only connections run with PRAGMA query_only, so SQLite itself
+    rejects any statement that would write or change the schema.
+    Args:
+        read_only: Return the thread's read-only connection instead
     Returns:
         SQLite database connection object
     """
-    try:
-        conn = sqlite3.connect('data.db')
-        conn.row_factory = sqlite3.Row
+    attr = "read_conn" if read_only else "conn"
+    conn = getattr(_local, attr, None)
+    if conn is not None:
         return conn
-    except Exception as e:
-        raise e
+    conn = _open_db_connection(read_only)
+    setattr(_local, attr, conn)
+    _pooled_connections.append(conn)
+    return conn
+
+@atexit.register
+def _close_db_connections() -> None:
+    """Close every pooled connection at interpreter exit"""
+    for conn in _pooled_connections:
+        conn.close()
+    _pooled_connections.clear()
+
+def _get_db_version() -> Tuple[int, int, int]:
+    """
+    Get a cheap fingerprint of the database's on-disk state
+    In WAL mode commits land in the -wal file first, so both files are
+    checked. The WAL size is included because two commits can fall within
+    one filesystem timestamp tick.
+    Returns:
+        Tuple of (database mtime, WAL mtime or 0, WAL size or 0)
+    """
+    try:
+        wal_stat = os.stat(f"{DB_PATH}-wal")
+        wal_version = wal_stat.st_mtime_ns, wal_stat.st_size
+    except FileNotFoundError:
+        wal_version = 0, 0
+    return (os.stat(DB_PATH).st_mtime_ns, *wal_version)
+
+def invalidate_schema_cache() -> None:
+    """Drop the cached schema so the next get_db_schema() call rebuilds it"""
+    global _SCHEMA_CACHE
+    with _SCHEMA_LOCK:
+        _SCHEMA_CACHE = None
 
 def get_db_schema() -> str:
     """
-    Get database schema dynamically
+    Get database schema and column descriptions dynamically
+    The result is cached in-process until the database files change.
     Returns:
         String containing the database schema
     """
+    global _SCHEMA_CACHE
+    version = _get_db_version()
+    cached = _SCHEMA_CACHE
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _SCHEMA_LOCK:
+        # Another thread may have rebuilt it while we waited
+        if _SCHEMA_CACHE is not None and _SCHEMA_CACHE[0] == version:
+            return _SCHEMA_CACHE[1]
+
+        conn = get_db_connection()
+        while True:
+            # Each table's DDL joined with its column descriptions, one pass
+            rows = conn.execute(
+                "SELECT m.name, m.sql, d.column_name, d.description "
+                "FROM sqlite_master AS m "
+                "LEFT JOIN table_column_descriptions AS d ON d.table_name = m.name "
+                "WHERE m.type='table' "
+                "ORDER BY m.rowid, d.rowid;"
+            ).fetchall()
+            # The first read after startup creates the -wal file, and a write
+            # may land meanwhile; key the result on the version it was read at
+            read_version = _get_db_version()
+            if read_version == version:
+                break
+            version = read_version
+
+        # Streaming group-by: rows arrive grouped by table
+        create_statements: List[str] = []
+        description_lines: List[str] = []
+        current_table = None
+        for table, sql, column, description in rows:
+            if table != current_table:
+                current_table = table
+                if sql:
+                    create_statements.append(sql)
+                if column is not None:
+                    description_lines.append(f"\n{table} Table:")
+            if column is not None:
+                description_lines.append(f"- {column}: {description}")
+
+        schema = "\n".join(
+            [*create_statements, "", "Column Descriptions:", *description_lines]
+        )
+
+        _SCHEMA_CACHE = (version, schema)
+        return schema
+
+@lru_cache(maxsize=1)
+def _get_prompt_prefix(schema: str) -> str:
+    """
+    Build the schema part of the user prompt once per schema
+    The user query must always be appended last: everything before it is
+    identical across requests and can be served from OpenAI's prefix cache.
+    Args:
+        schema: Database schema string
+    Returns:
+        Prompt prefix that only needs the user query appended
+    """
+    return f"Database Schema:\n{schema}\n\nUser Query:\n"
+
+def _parse_reply(content: Optional[str], refusal: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Decode a structured-output reply from the model
+    Args:
+        content: JSON message content, None if the model refused
+        refusal: The model's refusal message, if any
+    Returns:
+        Reply object matching the requested response format
+    Raises:
+        SQLGenerationError: If the model refused to answer
+    """
+    if content is None:
+        raise SQLGenerationError(f"Model refused the request: {refusal}")
+    return orjson.loads(content)
+
+@lru_cache(maxsize=1)
+def _get_client() -> "AsyncOpenAI":
+    """
+    Create the shared OpenAI client on first use
+    openai and httpx are imported here, so code that only touches the
+    database never pays their import cost.
+    Returns:
+        AsyncOpenAI client backed by a long-lived pooled HTTP/2 connection
+    Raises:
+        ValueError: If the API key is not configured
+    """
+    import httpx
+    from openai import AsyncOpenAI
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("API key not found in .env file")
+    # Fail fast on an unreachable API instead of the SDK's 10 minute default
+    timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=timeout,
+        # httpx drops idle connections after 5 s by default; keep them for a
+        # minute so sporadic traffic doesn't pay a new TLS handshake
+        limits=httpx.Limits(
+            max_keepalive_connections=50, max_connections=100, keepalive_expiry=60
+        ),
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=http_client,
+        timeout=timeout,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+
+def _completion_timeout(max_tokens: int) -> Any:
+    """
+    Timeout for a completion allowed to generate up to max_tokens
+    Args:
+        max_tokens: Completion token limit of the request
+    Returns:
+        httpx.Timeout no shorter than the client default
+    """
+    import httpx
+
+    read_timeout = max(OPENAI_TIMEOUT, max_tokens / OPENAI_MIN_TOKENS_PER_SECOND)
+    return httpx.Timeout(read_timeout, connect=OPENAI_CONNECT_TIMEOUT)
+
+@lru_cache(maxsize=1)
+def _get_rate_limiters() -> Tuple[Any, Any]:
+    """
+    Create the request and token rate limiters on first use
+    Returns:
+        Tuple of (requests-per-minute limiter, tokens-per-minute limiter),
+        each None when its limit is not configured
+    """
+    if OPENAI_RPM is None and OPENAI_TPM is None:
+        return None, None
+    from aiolimiter import AsyncLimiter  # Only needed when a limit is set
+
+    return (
+        AsyncLimiter(OPENAI_RPM, 60) if OPENAI_RPM is not None else None,
+        AsyncLimiter(OPENAI_TPM, 60) if OPENAI_TPM is not None else None,
+    )
+
+def _estimate_tokens(request: Dict[str, Any]) -> int:
+    """Rough upper bound on a completion's tokens: ~4 chars per prompt token"""
+    prompt_chars = sum(len(message["content"]) for message in request["messages"])
+    return prompt_chars // 4 + request.get("max_tokens", SQL_MAX_TOKENS)
+
+async def _create_completion(**kwargs: Any) -> Any:
+    """
+    Call the chat completions API behind the circuit breaker
+    Args:
+        **kwargs: Arguments for chat.completions.create
+    Returns:
+        Chat completion response from OpenAI
+    Raises:
+        SQLGenerationError: If the breaker is open
+    """
+    global _breaker_failures, _breaker_open_until
+    remaining = _breaker_open_until - time.monotonic()
+    if remaining > 0:
+        raise SQLGenerationError(
+            f"OpenAI API is failing, not retrying for another {remaining:.0f}s"
+        )
+
+    request_limiter, token_limiter = _get_rate_limiters()
+    if request_limiter is not None:
+        await request_limiter.acquire()
+    if token_limiter is not None:
+        await token_limiter.acquire(min(_estimate_tokens(kwargs), token_limiter.max_rate))
+
+    client = _get_client()
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT sql FROM sqlite_master WHERE type='table';")
-            schema = cursor.fetchall()
-            return "\n".join([row[0] for row in schema if row[0]])
-    except Exception as e:
-        raise e
+        response = await client.chat.completions.create(**kwargs)
+    except (APIConnectionError, InternalServerError, RateLimitError):
+        # Raised only once the SDK's own retries are exhausted
+        with _BREAKER_LOCK:
+            _breaker_failures += 1
+            if _breaker_failures >= BREAKER_FAIL_MAX:
+                # Stays at the limit, so one more failure after the pause
+                # opens the breaker again
+                _breaker_open_until = time.monotonic() + BREAKER_RESET_TIMEOUT
+                logger.warning("OpenAI circuit breaker open for %.0fs", BREAKER_RESET_TIMEOUT)
+        raise
+    with _BREAKER_LOCK:
+        _breaker_failures = 0
+    return response
+
+def _record_usage(response: Any) -> Dict[str, int]:
+    """
+    Log token usage for one completion and add it to the running totals
+    Args:
+        response: Chat completion response from OpenAI
+    Returns:
+        Dictionary with prompt, cached and completion token counts
+    """
+    usage = response.usage
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached_tokens = details.get("cached_tokens")
+    else:
+        cached_tokens = getattr(details, "cached_tokens", None)
+    usage_dict = {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": cached_tokens or 0,
+        "completion_tokens": usage.completion_tokens,
+    }
+    with _USAGE_LOCK:
+        _USAGE_TOTALS["requests"] += 1
+        for key, value in usage_dict.items():
+            _USAGE_TOTALS[key] += value
+    logger.info(
+        "OpenAI usage prompt_tokens=%d cached_tokens=%d completion_tokens=%d cache_hit_ratio=%.2f",
+        usage_dict["prompt_tokens"],
+        usage_dict["cached_tokens"],
+        usage_dict["completion_tokens"],
+        usage_dict["cached_tokens"] / max(usage_dict["prompt_tokens"], 1),
+    )
+    return usage_dict
 
-def generate_sql_query(natural_query: str) -> str:
+def get_usage_stats() -> Dict[str, Any]:
+    """
+    Get OpenAI token usage totals since process start
+    Returns:
+        Dictionary of request/token totals plus the prompt cache hit ratio
+    """
+    with _USAGE_LOCK:
+        stats: Dict[str, Any] = dict(_USAGE_TOTALS)
+    stats["cache_hit_ratio"] = stats["cached_tokens"] / max(stats["prompt_tokens"], 1)
+    return stats
+
+def _choose_model(natural_query: str) -> str:
+    """
+    Pick the model for a request
+    Args:
+        natural_query: Natural language query string
+    Returns:
+        SQL_COMPLEX_MODEL for long or analytical requests, else SQL_MODEL
+    """
+    if len(natural_query) > COMPLEX_QUERY_MIN_LENGTH or _COMPLEX_QUERY_RE.search(natural_query):
+        return SQL_COMPLEX_MODEL
+    return SQL_MODEL
+
+def _normalize_query(natural_query: str) -> str:
+    """Lowercase a natural language query, drop punctuation and collapse whitespace"""
+    return " ".join(_QUERY_PUNCT_RE.sub(" ", natural_query.lower()).split())
+
+def _sync_cache_with_schema(schema_digest: str) -> None:
+    """
+    Empty both cache tiers if the schema changed since they were filled
+    Args:
+        schema_digest: SHA-256 hex digest of the current schema
+    """
+    global _sql_cache_schema_digest, _semantic_embeddings
+    with _SQL_CACHE_LOCK:
+        if schema_digest != _sql_cache_schema_digest:
+            # SQL generated against the old schema is stale
+            _SQL_CACHE.clear()
+            _semantic_embeddings = None
+            _semantic_queries.clear()
+            _semantic_expiry.clear()
+            _sql_cache_schema_digest = schema_digest
+
+def _cache_get(cache_key: str) -> Optional[str]:
+    """Look up unexpired SQL in the exact tier, marking it most recently used"""
+    with _SQL_CACHE_LOCK:
+        entry = _SQL_CACHE.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _SQL_CACHE[cache_key]
+            return None
+        _SQL_CACHE.move_to_end(cache_key)
+        return entry[1]
+
+def _cache_put(cache_key: str, sql_query: str) -> None:
+    """Store SQL in the exact tier, evicting the least recently used entry"""
+    with _SQL_CACHE_LOCK:
+        _SQL_CACHE[cache_key] = (time.monotonic() + SQL_CACHE_TTL, sql_query)
+        _SQL_CACHE.move_to_end(cache_key)
+        if len(_SQL_CACHE) > SQL_CACHE_MAX_SIZE:
+            _SQL_CACHE.popitem(last=False)
+
+async def _embed_query(natural_query: str) -> Any:
+    """
+    Embed a natural language query for the semantic cache tier
+    Args:
+        natural_query: Natural language query string
+    Returns:
+        Unit-length numpy vector
+    """
+    import numpy as np  # Only needed when the semantic tier is enabled
+
+    response = await _get_client().embeddings.create(
+        model=EMBEDDING_MODEL, input=_normalize_query(natural_query)
+    )
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+def _semantic_cache_get(embedding: Any) -> Optional[str]:
+    """Return cached SQL for the most similar past query above the threshold"""
+    with _SQL_CACHE_LOCK:
+        if _semantic_embeddings is None:
+            return None
+        similarities = _semantic_embeddings @ embedding
+        best = int(similarities.argmax())
+        if (similarities[best] >= SEMANTIC_CACHE_THRESHOLD
+                and _semantic_expiry[best] > time.monotonic()):
+            return _semantic_queries[best]
+        return None
+
+def _semantic_cache_put(embedding: Any, sql_query: str) -> None:
+    """Add an embedding/SQL pair to the semantic tier, dropping the oldest"""
+    import numpy as np
+
+    global _semantic_embeddings
+    with _SQL_CACHE_LOCK:
+        if _semantic_embeddings is None:
+            _semantic_embeddings = embedding[np.newaxis, :]
+        else:
+            _semantic_embeddings = np.vstack(
+                [_semantic_embeddings[-(SQL_CACHE_MAX_SIZE - 1):], embedding]
+            )
+        _semantic_queries.append(sql_query)
+        del _semantic_queries[:-SQL_CACHE_MAX_SIZE]
+        _semantic_expiry.append(time.monotonic() + SQL_CACHE_TTL)
+        del _semantic_expiry[:-SQL_CACHE_MAX_SIZE]
+
+@lru_cache(maxsize=1)
+def _generation_errors() -> Tuple[type, ...]:
+    """
+    Exceptions that mean SQL generation failed
+    Only evaluated when an exception is being handled, so openai is still
+    imported lazily. SQLGenerationError itself passes through unwrapped.
+    Returns:
+        OpenAI API, schema loading and reply decoding errors
+    """
+    from openai import OpenAIError
+
+    return (OpenAIError, sqlite3.Error, OSError, ValueError, KeyError)
+
+async def aget_db_schema() -> str:
+    """
+    Get the database schema on the SQLite worker pool without blocking the event loop
+    Returns:
+        String containing the database schema
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, get_db_schema)
+
+async def _load_schema() -> Tuple[str, str]:
+    """
+    Fetch the schema off the event loop and sync the SQL cache with it
+    Returns:
+        Tuple of (schema, SHA-256 hex digest of the schema)
+    """
+    schema = await aget_db_schema()
+    schema_digest = hashlib.sha256(schema.encode()).hexdigest()
+    _sync_cache_with_schema(schema_digest)
+    return schema, schema_digest
+
+def _get_cache_key(schema_digest: str, natural_query: str) -> str:
+    """Build the exact-tier cache key for a query against a schema"""
+    return hashlib.blake2b(
+        f"{_choose_model(natural_query)}|{schema_digest}|{_normalize_query(natural_query)}".encode()
+    ).hexdigest()
+
+async def generate_sql_query(natural_query: str) -> str:
     """
     Convert natural language query to SQL
     Args:
@@ -64,71 +628,419 @@ def generate_sql_query(natural_query: str) -> str:
         SQLGenerationError: If query generation fails
     """
     try:
-        schema = get_db_schema()
-        prompt = f"""
-        Database Schema:
-        {schema}
+        schema, schema_digest = await _load_schema()
+        cache_key = _get_cache_key(schema_digest, natural_query)
+        cached_query = _cache_get(cache_key)
+        if cached_query is not None:
+            return cached_query
 
-        User Query:
-        {natural_query}
-        """
+        embedding = None
+        if SEMANTIC_CACHE_THRESHOLD is not None:
+            embedding = await _embed_query(natural_query)
+            cached_query = _semantic_cache_get(embedding)
+            if cached_query is not None:
+                _cache_put(cache_key, cached_query)
+                return cached_query
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        prompt = _get_prompt_prefix(schema) + natural_query
+
+        response = await _create_completion(
+            model=_choose_model(natural_query),
             messages=[
-                {"role": "system", "content": """
-                You are a SQL query converter. The database has the following tables:
-                  
-                    
-                Create queries according to this schema and use exact table/column names.
-                Case sensitivity in requests doesn't matter.
-                Please return only the SQL query, no additional explanations.
-                Use UPPERCASE for all SQL keywords.
-                Use proper indentation.
-                For potentially dangerous operations. (operations such as deleting the table,changing the data,changing the schema ) Ask the user if he is sure, if so, use the same command. Accept when you say "I grant administrative permission"
-                """},
+                _SYSTEM_MESSAGE,
                 {"role": "user", "content": prompt}
-            ]
+            ],
+            temperature=SQL_TEMPERATURE,
+            max_tokens=SQL_MAX_TOKENS,
+            response_format=_SQL_RESPONSE_FORMAT,
         )
+        _record_usage(response)
 
-        generated_query = response.choices[0].message.content.strip()
+        message = response.choices[0].message
+        generated_query = _parse_reply(message.content, message.refusal)["sql"].strip()
+        _cache_put(cache_key, generated_query)
+        if embedding is not None:
+            _semantic_cache_put(embedding, generated_query)
         return generated_query
 
-    except Exception as e:
+    except _generation_errors() as e:
         raise SQLGenerationError(f"Error generating SQL query: {str(e)}") from e
 
-def execute_sql_query(query: str) -> List[Dict[str, Any]]:
+async def _generate_sql_chunk(schema: str, natural_queries: List[str]) -> List[str]:
+    """
+    Convert up to BATCH_MAX_QUERIES natural language queries in one request
+    Args:
+        schema: Database schema string
+        natural_queries: Natural language query strings
+    Returns:
+        Generated SQL strings in input order
+    Raises:
+        SQLGenerationError: If the model refuses or answers the wrong count
+    """
+    numbered_queries = "\n".join(
+        f"{n}) {query}" for n, query in enumerate(natural_queries, 1)
+    )
+    prompt = (
+        _get_prompt_prefix(schema)
+        + "Write one SQL query for each numbered request below, "
+        "in the same order.\n"
+        + numbered_queries
+    )
+    # One request, so the chunk uses the larger model if any query needs it
+    models = {_choose_model(query) for query in natural_queries}
+    max_tokens = SQL_MAX_TOKENS * len(natural_queries)
+    response = await _create_completion(
+        model=SQL_COMPLEX_MODEL if SQL_COMPLEX_MODEL in models else SQL_MODEL,
+        messages=[
+            _SYSTEM_MESSAGE,
+            {"role": "user", "content": prompt}
+        ],
+        temperature=SQL_TEMPERATURE,
+        max_tokens=max_tokens,
+        response_format=_SQL_BATCH_RESPONSE_FORMAT,
+        # A full chunk can take minutes to generate
+        timeout=_completion_timeout(max_tokens),
+    )
+    _record_usage(response)
+
+    message = response.choices[0].message
+    answers = _parse_reply(message.content, message.refusal)["queries"]
+    if len(answers) != len(natural_queries):
+        raise SQLGenerationError(
+            f"Expected {len(natural_queries)} answers, got {len(answers)}"
+        )
+    return [answer.strip() for answer in answers]
+
+async def generate_sql_queries_batch(natural_queries: List[str]) -> List[Tuple[str, str]]:
+    """
+    Convert several natural language queries to SQL in as few OpenAI requests as possible
+    Cached queries are answered locally; the rest are numbered and sent
+    together, so the schema prefix and the round trip are paid once per
+    BATCH_MAX_QUERIES queries. Larger batches are split into concurrent
+    requests to stay within the model's output token limit.
+    Args:
+        natural_queries: Natural language query strings
+    Returns:
+        List of (natural query, generated SQL) tuples in input order
+    Raises:
+        SQLGenerationError: If query generation fails
+    """
+    try:
+        schema, schema_digest = await _load_schema()
+        cache_keys = [_get_cache_key(schema_digest, query) for query in natural_queries]
+        generated: List[Optional[str]] = [_cache_get(key) for key in cache_keys]
+        pending = [i for i, sql_query in enumerate(generated) if sql_query is None]
+
+        chunks = [
+            pending[start:start + BATCH_MAX_QUERIES]
+            for start in range(0, len(pending), BATCH_MAX_QUERIES)
+        ]
+        chunk_answers = await asyncio.gather(*(
+            _generate_sql_chunk(schema, [natural_queries[i] for i in chunk])
+            for chunk in chunks
+        ))
+        for chunk, answers in zip(chunks, chunk_answers):
+            for i, answer in zip(chunk, answers):
+                generated[i] = answer
+                _cache_put(cache_keys[i], answer)
+
+        return list(zip(natural_queries, generated))
+
+    except _generation_errors() as e:
+        raise SQLGenerationError(f"Error generating SQL queries: {str(e)}") from e
+
+async def generate_sql_queries_offline(
+    natural_queries: List[str], poll_interval: float = 60.0
+) -> List[Tuple[str, str]]:
+    """
+    Convert natural language queries to SQL through the OpenAI Batch API
+    For bulk, non-interactive jobs: batched requests cost about half as much
+    but may take up to 24 hours, so this polls until the batch finishes.
+    Cached queries are answered locally and left out of the batch.
+    Args:
+        natural_queries: Natural language query strings
+        poll_interval: Seconds to wait between batch status checks
+    Returns:
+        List of (natural query, generated SQL) tuples in input order
+    Raises:
+        SQLGenerationError: If the batch fails or any request in it fails
+    """
+    try:
+        schema, schema_digest = await _load_schema()
+        prompt_prefix = _get_prompt_prefix(schema)
+        cache_keys = [_get_cache_key(schema_digest, query) for query in natural_queries]
+        generated: List[Optional[str]] = [_cache_get(key) for key in cache_keys]
+        pending = [i for i, sql_query in enumerate(generated) if sql_query is None]
+
+        if pending:
+            client = _get_client()
+            batch_input = b"\n".join(
+                orjson.dumps({
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": _choose_model(natural_queries[i]),
+                        "messages": [
+                            _SYSTEM_MESSAGE,
+                            {"role": "user", "content": prompt_prefix + natural_queries[i]}
+                        ],
+                        "temperature": SQL_TEMPERATURE,
+                        "max_tokens": SQL_MAX_TOKENS,
+                        "response_format": _SQL_RESPONSE_FORMAT,
+                    },
+                })
+                for i in pending
+            )
+            input_file = await client.files.create(
+                file=("sql_batch.jsonl", batch_input), purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(poll_interval)
+                batch = await client.batches.retrieve(batch.id)
+            if batch.status != "completed" or batch.output_file_id is None:
+                raise SQLGenerationError(f"Batch {batch.id} ended with status {batch.status}")
+
+            output = await client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                result = orjson.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue  # Reported as missing below
+                i = int(result["custom_id"])
+                message = response["body"]["choices"][0]["message"]
+                generated[i] = _parse_reply(message["content"], message.get("refusal"))["sql"].strip()
+                _cache_put(cache_keys[i], generated[i])
+
+            missing = [natural_queries[i] for i in pending if generated[i] is None]
+            if missing:
+                raise SQLGenerationError(f"Batch {batch.id} returned no SQL for: {missing}")
+
+        return list(zip(natural_queries, generated))
+
+    except _generation_errors() as e:
+        raise SQLGenerationError(f"Error generating SQL queries: {str(e)}") from e
+
+@lru_cache(maxsize=1024)
+def is_read_only_query(query: str) -> bool:
+    """
+    Check whether a SQL string is a single read-only statement
+    The query is parsed with sqlglot, so CTEs, comments and leading
+    whitespace are handled; anything unparseable counts as a write.
+    Results are memoized: generated SQL is classified again when it is
+    executed, and cached SQL repeats.
+    Args:
+        query: SQL query string
+    Returns:
+        True if the query is a single SELECT (or compound SELECT)
+    """
+    # Fast path: a statement starting with SELECT cannot write, and sqlite3
+    # refuses to execute more than one statement per call
+    if _SELECT_RE.match(query):
+        return True
+
+    import sqlglot  # Deferred: only needed off the fast path
+    from sqlglot import exp
+
+    try:
+        statements = [
+            statement for statement in sqlglot.parse(query, read="sqlite")
+            if statement is not None
+        ]
+    except sqlglot.errors.SqlglotError:
+        return False
+    return len(statements) == 1 and isinstance(statements[0], (exp.Select, exp.Union))
+
+def _clear_result_cache() -> None:
+    """Drop every cached query result"""
+    global _result_cache_rows
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE.clear()
+        _result_cache_rows = 0
+
+def _result_cache_put(cache_key: Tuple[Any, ...], results: List[Dict[str, Any]]) -> None:
+    """Cache a query result, evicting least recently used ones to stay in bounds"""
+    global _result_cache_rows
+    with _RESULT_CACHE_LOCK:
+        previous = _RESULT_CACHE.pop(cache_key, None)
+        if previous is not None:
+            _result_cache_rows -= len(previous)
+        _RESULT_CACHE[cache_key] = results
+        _result_cache_rows += len(results)
+        while (len(_RESULT_CACHE) > RESULT_CACHE_MAX_SIZE
+               or _result_cache_rows > RESULT_CACHE_MAX_ROWS):
+            _, evicted = _RESULT_CACHE.popitem(last=False)
+            _result_cache_rows -= len(evicted)
+
+def _run_sql_query(
+    query: str, params: Sequence[Any], read_only: bool, batch_size: int
+) -> Iterator[Dict[str, Any]]:
+    """Execute an already classified SQL query and yield its rows"""
+    try:
+        # The with block commits writes (or rolls back on error)
+        with get_db_connection(read_only=read_only) as conn:
+            cursor = conn.cursor()
+            # Rows are turned into dicts below; plain tuples skip the
+            # per-row sqlite3.Row allocation
+            cursor.row_factory = None
+            cursor.execute(query, params)
+
+            if cursor.description is not None:  # Only statements returning rows
+                # Resolved once per cursor and shared by every row
+                columns = tuple(description[0] for description in cursor.description)
+                rows = cursor.fetchmany(batch_size)
+                while rows:
+                    for row in rows:
+                        yield dict(zip(columns, row))
+                    rows = cursor.fetchmany(batch_size)
+
+        if not read_only:
+            # The statement may have been DDL, and cached results may be stale
+            invalidate_schema_cache()
+            _clear_result_cache()
+
+    except sqlite3.Error as e:
+        raise SQLExecutionError(f"Error executing SQL query: {str(e)}") from e
+
+def execute_sql_query_iter(
+    query: str, params: Sequence[Any] = (), batch_size: int = 1000
+) -> Iterator[Dict[str, Any]]:
+    """
+    Execute SQL query and yield result rows lazily
+    Rows are fetched batch_size at a time, so memory stays bounded for large
+    SELECTs. Nothing runs until iteration starts; writes are committed once
+    the iterator is exhausted. Consume it on the thread that created it.
+    Args:
+        query: SQL query string to execute
+        params: Values bound to ? placeholders in the query
+        batch_size: Number of rows fetched from SQLite per round trip
+    Yields:
+        One dictionary per result row
+    Raises:
+        SQLExecutionError: If query execution fails
+    """
+    return _run_sql_query(query, params, is_read_only_query(query), batch_size)
+
+def execute_sql_query(query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
     """
     Execute SQL query and return results
+    Results of deterministic read-only queries are cached until the database
+    changes; the returned list may be shared, so callers must not modify it.
     Args:
         query: SQL query string to execute
+        params: Values bound to ? placeholders in the query
     Returns:
         List of dictionaries containing query results
     Raises:
         SQLExecutionError: If query execution fails
     """
+    read_only = is_read_only_query(query)
+    if not read_only or _NONDETERMINISTIC_RE.search(query):
+        return list(_run_sql_query(query, params, read_only, 1000))
+
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            
-            if cursor.description is None:  # For non-SELECT queries
-                conn.commit()
-                return []
-                
-            columns = [description[0] for description in cursor.description]
-            results = cursor.fetchall()
-            
-            if not results:  # For empty results
-                return []
-                
-            formatted_results = [
-                {columns[i]: value for i, value in enumerate(row)}
-                for row in results
-            ]
-            
-            return formatted_results
-
-    except Exception as e:
+        # Named (:name) params come as a mapping; tuple() would keep only its keys
+        params_key = frozenset(params.items()) if isinstance(params, Mapping) else tuple(params)
+        cache_key = (query, params_key, _get_db_version())
+        hash(cache_key)
+    except TypeError:
+        # Unhashable params (e.g. nested lists) can't key the cache; SQLite
+        # reports the binding error itself
+        return list(_run_sql_query(query, params, read_only, 1000))
+    except OSError as e:
+        raise SQLExecutionError(f"Error executing SQL query: {str(e)}") from e
+    with _RESULT_CACHE_LOCK:
+        results = _RESULT_CACHE.get(cache_key)
+        if results is not None:
+            _RESULT_CACHE.move_to_end(cache_key)
+            return results
+
+    results = list(_run_sql_query(query, params, read_only, 1000))
+    if len(results) <= RESULT_CACHE_MAX_ENTRY_ROWS:
+        _result_cache_put(cache_key, results)
+    return results
+
+def stream_sql_query(
+    query: str, params: Sequence[Any] = (), batch_size: int = 1000
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Run a read-only query on its own connection and return its rows in batches
+    The query is executed before this returns, so errors surface here rather
+    than mid-stream. The returned generator owns the connection: it may be
+    advanced from any thread and closes the connection when it finishes.
+    Args:
+        query: SQL query string to execute
+        params: Values bound to ? placeholders in the query
+        batch_size: Maximum number of rows per yielded batch
+    Returns:
+        Generator of row dictionary lists
+    Raises:
+        SQLExecutionError: If the query is not read-only or fails
+    """
+    if not is_read_only_query(query):
+        raise SQLExecutionError("Only read-only queries can be streamed")
+    try:
+        conn = _open_db_connection(read_only=True)
+    except sqlite3.Error as e:
+        raise SQLExecutionError(f"Error executing SQL query: {str(e)}") from e
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(query, params)
+    except sqlite3.Error as e:
+        conn.close()
         raise SQLExecutionError(f"Error executing SQL query: {str(e)}") from e
 
+    def batches() -> Iterator[List[Dict[str, Any]]]:
+        try:
+            columns = tuple(description[0] for description in cursor.description)
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                yield [dict(zip(columns, row)) for row in rows]
+                rows = cursor.fetchmany(batch_size)
+        except sqlite3.Error as e:
+            raise SQLExecutionError(f"Error executing SQL query: {str(e)}") from e
+        finally:
+            conn.close()
+
+    return batches()
+
+async def aexecute_sql_query(query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+    """
+    Execute SQL query on the SQLite worker pool without blocking the event loop
+    Args:
+        query: SQL query string to execute
+        params: Values bound to ? placeholders in the query
+    Returns:
+        List of dictionaries containing query results
+    Raises:
+        SQLExecutionError: If query execution fails
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, execute_sql_query, query, params)
+
+async def process_natural_query(natural_query: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Generate SQL for a natural language query and run it
+    Only read-only SQL is executed; anything else (a write, or the model's
+    confirmation question for a dangerous operation) is returned unexecuted
+    with empty results. Independent queries can be awaited concurrently,
+    e.g. asyncio.gather(*(process_natural_query(q) for q in queries)).
+    Args:
+        natural_query: Natural language query string
+    Returns:
+        Tuple of (generated SQL, query results)
+    Raises:
+        SQLGenerationError: If query generation fails
+        SQLExecutionError: If query execution fails
+    """
+    sql_query = await generate_sql_query(natural_query)
+    if not is_read_only_query(sql_query):
+        return sql_query, []
+    results = await aexecute_sql_query(sql_query)
+    return sql_query, results